@@ -1,13 +1,20 @@
+import hashlib
 import os
 import re
+import threading
 import time
-import requests
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from string import Template
+import diskcache
+import numpy as np
 import streamlit as st
-from bs4 import BeautifulSoup
 from dotenv import load_dotenv
-from duckduckgo_search import DDGS
-from rag import build_context_with_retrieval
+from rag import build_context_with_retrieval, get_embedder, warm_up_embedder
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import Callable, Iterator
 log_file_path=os.path.join(os.path.dirname(os.path.dirname(__file__)), './app.log')
 # log_file_path = os.path.join('/tmp', 'app.log') # uncomment this if you want to deploy the code on Hugging Face
 logging.basicConfig(
@@ -16,8 +23,11 @@ logging.basicConfig(
     format='%(asctime)s %(levelname)s %(name)s: %(message)s'
 )
 from huggingface_hub import InferenceClient
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from geopy.adapters import RequestsAdapter
+from geopy.extra.rate_limiter import RateLimiter
 from geopy.geocoders import Nominatim
-from geopy.distance import geodesic
+from urllib3.util.retry import Retry
 from pdf_utils import create_pdf
 
 load_dotenv()
@@ -26,10 +36,12 @@ st.set_page_config(page_title="AI Trip Planner", page_icon="🧭", layout="cente
 
 HF_TOKEN = os.getenv("HF_TOKEN") or st.secrets.get("HF_TOKEN") if hasattr(st, "secrets") else None
 DEFAULT_MODEL = os.getenv("HF_MODEL_ID", "HuggingFaceH4/zephyr-7b-beta")
+HF_TIMEOUT = float(os.getenv("HF_TIMEOUT", "120"))
 
 @st.cache_resource
 def get_client(token: str | None):
-    return InferenceClient(token=token)
+    # Bounded timeout so a stalled endpoint fails over instead of hanging the request
+    return InferenceClient(token=token, timeout=HF_TIMEOUT)
 
 client = get_client(HF_TOKEN)
 
@@ -47,20 +59,102 @@ st.markdown(
 
 @st.cache_resource
 def get_geocoder():
-    return Nominatim(user_agent="trip_planner_ui")
+    # Pooled keep-alive session so repeated lookups skip the TCP/TLS handshake
+    adapter_factory = partial(
+        RequestsAdapter,
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, backoff_factor=0.3),
+    )
+    return Nominatim(user_agent="trip_planner_ui", adapter_factory=adapter_factory)
 
 geocoder = get_geocoder()
 
+@st.cache_resource
+def get_geocode_limited():
+    # One shared limiter so concurrent cold lookups still respect Nominatim's ~1 req/s policy
+    return RateLimiter(geocoder.geocode, min_delay_seconds=1.1, max_retries=0, swallow_exceptions=False)
+
+geocode_limited = get_geocode_limited()
+
+GEO_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data', 'geo_cache')
+# GEO_CACHE_DIR = os.path.join('/tmp', 'geo_cache') # uncomment this if you want to deploy the code on Hugging Face
+GEO_CACHE_TTL_S = 30 * 86400
+
+@st.cache_resource
+def get_geo_cache():
+    return diskcache.Cache(GEO_CACHE_DIR)
+
+geo_cache = get_geo_cache()
+
+def _normalize_place(place: str) -> str:
+    return " ".join(place.split()).lower()
+
+def _geocode_uncached(place_norm: str):
+    # Exceptions propagate so transient failures are never memoized
+    hit = geo_cache.get(place_norm)
+    if hit is not None:
+        return hit
+    loc = geocode_limited(place_norm, timeout=10)
+    if loc:
+        result = (loc.latitude, loc.longitude, loc.address)
+        geo_cache.set(place_norm, result, expire=GEO_CACHE_TTL_S)
+        return result
+    return None
+
+@st.cache_resource
+def get_geocode_memo():
+    # Built once per process; a module-level lru_cache would be rebuilt on every Streamlit rerun
+    return lru_cache(maxsize=4096)(_geocode_uncached)
+
+geocode_memo = get_geocode_memo()
+
 def geocode_place(place: str):
-    if not place:
+    if not place or not place.strip():
         return None
     try:
-        loc = geocoder.geocode(place, timeout=10)
-        if loc:
-            return (loc.latitude, loc.longitude, loc.address)
+        return geocode_memo(_normalize_place(place))
     except Exception:
         return None
-    return None
+
+def geocode_places(places: list[str]) -> list:
+    # Only cold, distinct places go to the pool (and through the rate limiter); cached ones resolve inline
+    keys = [_normalize_place(p) if p and p.strip() else "" for p in places]
+    cold = list(dict.fromkeys(k for k in keys if k and k not in geo_cache))
+    resolved = {}
+    if len(cold) > 1:
+        with ThreadPoolExecutor(max_workers=min(len(cold), 4)) as ex:
+            resolved = dict(zip(cold, ex.map(geocode_place, cold)))
+    return [resolved[k] if k in resolved else geocode_place(p) for p, k in zip(places, keys)]
+
+EARTH_RADIUS_KM = 6371.0
+
+def haversine_km(lat1, lon1, lat2, lon2) -> np.ndarray:
+    # Closed-form great-circle distance; broadcasts over scalars or equal-length arrays
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+@dataclass(frozen=True, slots=True)
+class UserInput:
+    source: str
+    destination: str
+    start_date: str
+    end_date: str
+    num_people: int
+    age_group: str
+    budget: int
+    currency: str
+    travel_style: str
+    interests: tuple[str, ...]
+    preferences: str
+    accommodation_type: tuple[str, ...]
+    accommodation_style: str
+    internet_required: bool
+    sim_card_required: bool
+    travel_insurance: bool
+    special_assistance: bool
+    duration: int
 
 def validate_dates(start, end):
     if start >= end:
@@ -100,90 +194,145 @@ with st.form("trip_form"):
     submitted = st.form_submit_button("✨ Generate Itinerary")
 
 
-def ddg_search(query: str, max_results: int = 6):
-    try:
-        with DDGS() as ddgs:
-            return list(ddgs.text(query, max_results=max_results))
-    except Exception:
-        return []
-
-
-def fetch_page_text(url: str, max_chars: int = 3500) -> str:
-    try:
-        headers = {"User-Agent": "Mozilla/5.0"}
-        r = requests.get(url, headers=headers, timeout=10)
-        r.raise_for_status()
-        soup = BeautifulSoup(r.text, "html.parser")
-        for tag in soup(["script", "style", "nav", "footer", "header", "aside"]):
-            tag.decompose()
-        text = soup.get_text(" ")
-        text = re.sub(r"\s+", " ", text).strip()
-        return text[:max_chars]
-    except Exception:
-        return ""
-
-
-def build_web_context(query: str, top_k: int = 3) -> str:
-    results = ddg_search(query, max_results=8)
-    blocks = []
-    count = 0
-    for res in results:
-        if count >= top_k:
-            break
-        url = res.get("href") or res.get("link") or ""
-        title = res.get("title") or "Source"
-        snippet = res.get("body") or ""
-        body = fetch_page_text(url) if url else ""
-        if body or snippet:
-            count += 1
-            blocks.append(f"---\nTitle: {title}\nURL: {url}\nSnippet: {snippet}\nExtract: {body}\n")
-        time.sleep(0.4)
-    return "\n".join(blocks)
+def script_thread_pool(max_workers: int) -> ThreadPoolExecutor:
+    # Workers inherit this session's ScriptRunContext so st.cache_* calls inside them behave
+    ctx = get_script_run_ctx()
+    return ThreadPoolExecutor(
+        max_workers=max_workers,
+        initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx),
+    )
 
 MAX_NEW_TOKENS = 1500
+# One long first pass is cheaper than several short ones: each extra call re-pays prefill and network overhead
+FIRST_PASS_MAX_TOKENS = 3000
+# A couple of missing sections only need a short, targeted call
+TARGETED_MAX_TOKENS = 600
+CONTINUATION_TAIL_CHARS = 1500
 TEMPERATURE = 0.9
 
-def generate_text(model_id: str, prompt: str, max_new_tokens: int, temperature: float) -> str:
-    # First try text generation; if unsupported, fall back to chat completion
+SYSTEM_PROMPT = "You are a helpful assistant."
+
+def _chat_messages(prompt: str, system_prompt: str) -> list[dict]:
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": prompt},
+    ]
+
+def _message_content(out) -> str:
+    # Normalize different return shapes
+    choices = getattr(out, "choices", None)
+    if choices and len(choices) > 0:
+        msg = getattr(choices[0], "message", None)
+        if msg is not None:
+            content = getattr(msg, "content", None)
+            if isinstance(content, str):
+                return content
+    if isinstance(out, dict):
+        ch = out.get("choices") or []
+        if ch:
+            content = (ch[0].get("message") or {}).get("content")
+            if isinstance(content, str):
+                return content
+    return str(out)
+
+def _iter_chat_deltas(stream) -> Iterator[str]:
+    for chunk in stream:
+        choices = getattr(chunk, "choices", None)
+        if not choices:
+            continue
+        delta = getattr(choices[0], "delta", None)
+        content = getattr(delta, "content", None) if delta is not None else None
+        if content:
+            yield content
+
+def _chat_stream(prompt: str, system_prompt: str, max_new_tokens: int, temperature: float) -> Iterator[str]:
+    messages = _chat_messages(prompt, system_prompt)
     try:
-        return client.text_generation(
+        stream = client.chat_completion(
             model='google/gemma-2-9b-it',
-            prompt=prompt,
-            max_new_tokens=max_new_tokens,
+            messages=messages,
+            max_tokens=max_new_tokens,
             temperature=temperature,
             top_p=0.9,
+            stream=True,
         )
+        return _iter_chat_deltas(stream)
     except Exception:
-        # Try chat completion format
+        # Streaming unsupported for this model/provider: fall back to a blocking call
+        out = client.chat_completion(
+            model='google/gemma-2-9b-it',
+            messages=messages,
+            max_tokens=max_new_tokens,
+            temperature=temperature,
+            top_p=0.9,
+        )
+        return iter([_message_content(out)])
+
+TEXT_GEN_FAIL_LIMIT = 2
+TEXT_GEN_COOLDOWN_S = 600
+
+@st.cache_resource
+def get_text_gen_health() -> dict:
+    # Per-model failure streak of the text-generation path, shared across sessions
+    return {}
+
+text_gen_health = get_text_gen_health()
+
+def _text_gen_state(model_id: str) -> dict:
+    return text_gen_health.setdefault(model_id, {"fail_streak": 0, "cooldown_until": 0.0})
+
+def _record_text_gen_failure(model_id: str, health: dict) -> None:
+    health["fail_streak"] += 1
+    if health["fail_streak"] >= TEXT_GEN_FAIL_LIMIT:
+        health["cooldown_until"] = time.time() + TEXT_GEN_COOLDOWN_S
+        logging.info("Text generation unavailable for %s; using chat completion for %ds", model_id, TEXT_GEN_COOLDOWN_S)
+
+def stream_text(
+    model_id: str,
+    prompt: str,
+    max_new_tokens: int,
+    temperature: float,
+    system_prompt: str = SYSTEM_PROMPT,
+) -> Iterator[str]:
+    # First try text generation; if unsupported, fall back to chat completion.
+    # The request is issued eagerly so that fallback happens before any token is yielded.
+    # After repeated failures text generation is skipped for a cooldown, saving a doomed round-trip.
+    health = _text_gen_state(model_id)
+    tokens = None
+    if time.time() >= health["cooldown_until"]:
         try:
-            messages = [
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": prompt},
-            ]
-            out = client.chat_completion(
+            tokens = client.text_generation(
                 model='google/gemma-2-9b-it',
-                messages=messages,
-                max_tokens=max_new_tokens,
+                prompt=f"{system_prompt}\n\n{prompt}",
+                max_new_tokens=max_new_tokens,
                 temperature=temperature,
                 top_p=0.9,
+                stream=True,
             )
-            # Normalize different return shapes
-            choices = getattr(out, "choices", None)
-            if choices and len(choices) > 0:
-                msg = getattr(choices[0], "message", None)
-                if msg is not None:
-                    content = getattr(msg, "content", None)
-                    if isinstance(content, str):
-                        return content
-            if isinstance(out, dict):
-                ch = out.get("choices") or []
-                if ch:
-                    content = (ch[0].get("message") or {}).get("content")
-                    if isinstance(content, str):
-                        return content
-            return str(out)
-        except Exception as e2:
-            raise e2
+            health["fail_streak"] = 0
+        except Exception:
+            _record_text_gen_failure(model_id, health)
+    if tokens is None:
+        tokens = _chat_stream(prompt, system_prompt, max_new_tokens, temperature)
+    yield from tokens
+
+def warm_up_prefix(model_id: str, system_prompt: str) -> None:
+    # One-token request on the text-generation path stream_text tries first, so the
+    # server can start caching the shared system prefix. Skipped while that path is
+    # cooling down, and a failure counts towards the cooldown like any other.
+    health = _text_gen_state(model_id)
+    if time.time() < health["cooldown_until"]:
+        return
+    try:
+        client.text_generation(
+            model='google/gemma-2-9b-it',
+            prompt=f"{system_prompt}\n\n",
+            max_new_tokens=1,
+        )
+        health["fail_streak"] = 0
+    except Exception as e:
+        logging.info("Prefix warm-up failed: %s", e)
+        _record_text_gen_failure(model_id, health)
 
 model_id = 'google/gemma-2-9b-it'
 
@@ -198,40 +347,74 @@ REQUIRED_SECTIONS = [
     "# Estimated Costs",
     "# Planner’s Recommendation",
 ]
-
-def _missing_sections(text: str) -> list[str]:
-    lower_text = text.lower()
-    missing = []
-    aliases = {
-        "# Trip Overview": ["# trip overview"],
-        "# Transport Plan": ["# transport plan"],
-        "# Stay Options": ["# stay options"],
-        "# Day-by-Day Itinerary": ["# day-by-day itinerary", "# day by day itinerary"],
-        "# Must-Try Food": ["# must-try food", "# must try food", "# food"],
-        "# Tickets & Pre-bookings": ["# tickets & pre-bookings", "# tickets and pre-bookings", "# tickets"],
-        "# Packing & Prep Checklist": ["# packing & prep checklist", "# packing checklist"],
-        "# Estimated Costs": ["# estimated costs", "# costs"],
-        "# Planner’s Recommendation": ["# planner’s recommendation", "# planners recommendation", "# planner recommendation"],
-    }
-    for section, keys in aliases.items():
-        if not any(k in lower_text for k in keys):
-            missing.append(section)
-    return missing
-
-def generate_full_itinerary(model_id: str, base_prompt: str) -> str:
-    parts: list[str] = []
+# Asked for "only if applicable": its absence doesn't make an itinerary incomplete
+OPTIONAL_SECTIONS = {"# Planner’s Recommendation"}
+
+# Heading patterns per required section, matched case-insensitively after one or more '#'
+SECTION_PATTERNS = {
+    "# Trip Overview": r"trip overview",
+    "# Transport Plan": r"transport plan",
+    "# Stay Options": r"stay options",
+    "# Day-by-Day Itinerary": r"day[- ]by[- ]day itinerary",
+    "# Must-Try Food": r"(?:must[- ]try )?food",
+    "# Tickets & Pre-bookings": r"tickets",
+    "# Packing & Prep Checklist": r"packing (?:(?:&|and) prep )?checklist",
+    "# Estimated Costs": r"(?:estimated )?costs",
+    "# Planner’s Recommendation": r"planner(?:’s|'s|s)? recommendation",
+}
+_SECTION_RE = re.compile(
+    # Headings only: '#' must open the line, and the spacing after it can't cross a newline
+    r"^#+[ \t]*(?:" + "|".join(f"(?P<s{i}>{pat})" for i, pat in enumerate(SECTION_PATTERNS.values())) + ")",
+    re.IGNORECASE | re.MULTILINE,
+)
+_SECTION_BY_GROUP = {f"s{i}": section for i, section in enumerate(SECTION_PATTERNS)}
+
+def _found_sections(text: str) -> set[str]:
+    # Single regex pass; no lowercased copy of the text
+    return {_SECTION_BY_GROUP[m.lastgroup] for m in _SECTION_RE.finditer(text)}
+
+def _missing_sections(found: set[str]) -> list[str]:
+    return [section for section in REQUIRED_SECTIONS if section not in found and section not in OPTIONAL_SECTIONS]
+
+STREAM_RENDER_INTERVAL_S = 0.15
+
+def _stream_pass(
+    model_id: str,
+    prompt: str,
+    system_prompt: str,
+    max_new_tokens: int,
+    prefix: str,
+    on_update: Callable[[str], None] | None,
+) -> str:
+    # Collect one generation pass, pushing the running text to on_update at a throttled rate
+    pieces: list[str] = []
+    last_render = 0.0
+    for token in stream_text(model_id, prompt, max_new_tokens, TEMPERATURE, system_prompt):
+        pieces.append(token)
+        now = time.monotonic()
+        if on_update and now - last_render >= STREAM_RENDER_INTERVAL_S:
+            on_update(prefix + "".join(pieces))
+            last_render = now
+    return "".join(pieces)
+
+def generate_full_itinerary(
+    model_id: str,
+    base_prompt: str,
+    on_update: Callable[[str], None] | None = None,
+    system_prompt: str = SYSTEM_PROMPT,
+) -> str:
+    # Every pass shares the same system message, so the server can reuse its cached prefix
     # First pass
-    first = generate_text(model_id, base_prompt, MAX_NEW_TOKENS, TEMPERATURE)
-    parts.append(first if isinstance(first, str) else str(first))
-    miss = _missing_sections(parts[0])
-    logging.info("Initial output length=%d, missing sections=%s", len(parts[0]), ", ".join(miss))
+    full_text = _stream_pass(model_id, base_prompt, system_prompt, FIRST_PASS_MAX_TOKENS, "", on_update)
+    found = _found_sections(full_text)
+    miss = _missing_sections(found)
+    logging.info("Initial output length=%d, missing sections=%s", len(full_text), ", ".join(miss))
     # Up to two continuations
     for _ in range(2):
         if not miss:
             break
         # Provide recent context so the model can continue seamlessly
-        so_far = "\n\n".join(parts)
-        tail = so_far[-4000:]  # include last chunk of text as context
+        tail = full_text[-CONTINUATION_TAIL_CHARS:]  # only enough to match tone; missing headings are listed explicitly
         cont_prompt = (
             "You are continuing an itinerary in Markdown. Below is the content generated so far.\n\n"
             f"EXISTING ITINERARY (partial):\n{tail}\n\n"
@@ -240,12 +423,193 @@ def generate_full_itinerary(model_id: str, base_prompt: str) -> str:
             "Do not ask the user for the existing text; continue directly.\n"
             "Do not repeat any sections already covered."
         )
-        cont = generate_text(model_id, cont_prompt, MAX_NEW_TOKENS, TEMPERATURE)
-        cont_str = cont if isinstance(cont, str) else str(cont)
-        parts.append(cont_str)
-        miss = _missing_sections("\n\n".join(parts))
+        max_tokens = TARGETED_MAX_TOKENS if len(miss) <= 2 else MAX_NEW_TOKENS
+        full_text += "\n\n"
+        cont_str = _stream_pass(model_id, cont_prompt, system_prompt, max_tokens, full_text, on_update)
+        full_text += cont_str
+        # Only the new pass needs scanning; earlier passes are already in found
+        found |= _found_sections(cont_str)
+        miss = _missing_sections(found)
         logging.info("Continuation length=%d, still missing=%s", len(cont_str), ", ".join(miss))
-    return "\n\n".join(parts)
+    return full_text
+
+def destination_query(destination: str) -> str:
+    return f"{destination} travel guide attractions tickets opening hours prices neighborhoods best time local food safety"
+
+def retrieval_params(num_destinations: int, num_interests: int) -> tuple[int, int]:
+    # (top_sources, k) per destination. Multi-city trips split the prompt budget,
+    # so fetch fewer pages per city; broad interest lists need more extracts.
+    top_sources = 3 if num_destinations <= 2 else 2
+    if num_interests == 0:
+        k = 4
+    elif num_interests >= 4:
+        k = 8
+    else:
+        k = 6
+    return top_sources, k
+
+DESTINATION_CONTEXT_TTL_S = 900
+SEMANTIC_CACHE_SIZE = 64
+SEMANTIC_CACHE_MIN_SIM = 0.92
+# Similar names are only the same place if they also geocode to the same spot
+# ("york" vs "new york", "paris" vs "paris texas")
+SEMANTIC_CACHE_MAX_KM = 10.0
+
+@st.cache_data(ttl=DESTINATION_CONTEXT_TTL_S, show_spinner=False)
+def _cached_destination_context(destination: str, top_sources: int, k: int) -> str:
+    context = build_context_with_retrieval(destination_query(destination), k=k, top_sources=top_sources)
+    if not context:
+        # Raise so an empty result from a failed search is not cached
+        raise LookupError(f"No research context for {destination}")
+    return context
+
+@st.cache_resource
+def get_semantic_context_cache():
+    # Shared across sessions: (lock, LRU of normalized name -> (embedding, (lat, lon), params, context, timestamp))
+    return threading.Lock(), OrderedDict()
+
+def _destination_key(destination: str) -> str:
+    return " ".join(destination.lower().split())
+
+def _embed_destination(destination: str) -> np.ndarray:
+    # Embed the bare name: the templated search query shares so many words
+    # across cities that different destinations would look alike
+    return get_embedder().encode([_destination_key(destination)], show_progress_bar=False, convert_to_numpy=True, normalize_embeddings=True)[0]
+
+def _exact_lookup(key: str, params: tuple[int, int]) -> str | None:
+    lock, cache = get_semantic_context_cache()
+    with lock:
+        entry = cache.get(key)
+        if entry is None or entry[2] != params or time.time() - entry[4] >= DESTINATION_CONTEXT_TTL_S:
+            return None
+        cache.move_to_end(key)
+        return entry[3]
+
+def _semantic_lookup(vec: np.ndarray, coords: tuple[float, float], params: tuple[int, int]) -> str | None:
+    lock, cache = get_semantic_context_cache()
+    now = time.time()
+    with lock:
+        keys = [key for key, (_, _, p, _, ts) in cache.items() if p == params and now - ts < DESTINATION_CONTEXT_TTL_S]
+        if not keys:
+            return None
+        sims = np.stack([cache[key][0] for key in keys]) @ vec
+        places = np.array([cache[key][1] for key in keys], dtype=np.float64)
+        dist_km = haversine_km(coords[0], coords[1], places[:, 0], places[:, 1])
+        # A near-identical name alone is not enough: the geocodes must agree too
+        ok = np.flatnonzero((sims >= SEMANTIC_CACHE_MIN_SIM) & (dist_km <= SEMANTIC_CACHE_MAX_KM))
+        if ok.size == 0:
+            return None
+        best = keys[int(ok[np.argmax(sims[ok])])]
+        cache.move_to_end(best)
+        return cache[best][3]
+
+def _semantic_store(key: str, vec: np.ndarray, coords: tuple[float, float], params: tuple[int, int], context: str) -> None:
+    lock, cache = get_semantic_context_cache()
+    with lock:
+        cache[key] = (vec, coords, params, context, time.time())
+        cache.move_to_end(key)
+        while len(cache) > SEMANTIC_CACHE_SIZE:
+            cache.popitem(last=False)
+
+def destination_context(destination: str, coords: tuple[float, float], top_sources: int = 3, k: int = 6) -> str:
+    # A near-identical spelling of an already researched place ("St. Petersburg"
+    # after "Saint Petersburg") reuses that research instead of searching again
+    params = (top_sources, k)
+    key = _destination_key(destination)
+    # Exact repeats are a dict lookup; only unseen names pay for an embedding
+    hit = _exact_lookup(key, params)
+    if hit is not None:
+        return hit
+    try:
+        vec = _embed_destination(destination)
+    except Exception as e:
+        logging.info("Destination embedding failed, skipping semantic cache: %s", e)
+        vec = None
+    if vec is not None:
+        hit = _semantic_lookup(vec, coords, params)
+        if hit is not None:
+            return hit
+    try:
+        context = _cached_destination_context(destination, top_sources, k)
+    except LookupError:
+        return ""
+    if vec is not None:
+        _semantic_store(key, vec, coords, params, context)
+    return context
+
+ITINERARY_CACHE_SIZE = 64
+
+@st.cache_resource
+def get_itinerary_cache():
+    # Shared across sessions: (lock, LRU of itinerary text keyed by prompt digest)
+    return threading.Lock(), OrderedDict()
+
+def itinerary_cache_key(model_id: str, prompt: str) -> str:
+    return hashlib.blake2b(f"{model_id}\n{prompt}".encode("utf-8"), digest_size=16).hexdigest()
+
+def get_cached_itinerary(key: str) -> str | None:
+    lock, cache = get_itinerary_cache()
+    with lock:
+        text = cache.get(key)
+        if text is not None:
+            cache.move_to_end(key)
+        return text
+
+def cache_itinerary(key: str, text: str) -> None:
+    lock, cache = get_itinerary_cache()
+    with lock:
+        cache[key] = text
+        cache.move_to_end(key)
+        while len(cache) > ITINERARY_CACHE_SIZE:
+            cache.popitem(last=False)
+
+# Static instructions lead every request so the inference server can reuse the prefilled prefix
+ITINERARY_SYSTEM_PROMPT = """You are an expert travel planner with deep knowledge of global destinations. Create a highly detailed, practical, and personalized travel itinerary based on the user's inputs and the current information provided.
+
+REQUIREMENTS
+- Plan end-to-end Source → Destination(s) → Source respecting dates and realistic transfers.
+- Include transport per leg with sample timings and fare ranges in the requested display currency; suggest booking sites/passes.
+- Stays: 2–3 options per destination across budget tiers (budget, mid, premium) with neighborhoods and typical nightly prices.
+- Must-visit places, sightseeing, leisure activities, authentic local food and specialties.
+- Tickets & pre-bookings: explicitly list items needing reservations or timed entry with indicative prices.
+- Packing & prep: travel gear, eSIM/SIM/connectivity, local transport apps, important contacts, nearest airports/railway stations.
+- Costs: itemized rough estimate per day and final total (show in INR and USD or both per selection).
+- If the trip seems too short for distances, add a concise "Planner’s recommendation" suggesting more sensible time.
+- If they have more than enough time, suggest nearby places to visit.
+- Include important links: transport booking sites, emergency contacts, and any pre-booking pages.
+- If local SIMs may not work at destination, suggest reliable eSIM or connectivity options.
+
+FORMAT (Markdown)
+# Trip Overview
+# Transport Plan (with timings and sample fares)
+# Stay Options (by destination and budget tier)
+# Day-by-Day Itinerary (dates; morning/afternoon/evening)
+# Must-Try Food & Specialties
+# Tickets & Pre-bookings
+# Packing & Prep Checklist
+# Estimated Costs (daily + final total in requested currencies)
+# Planner’s Recommendation (only if applicable)
+"""
+
+# Compiled once at import; filled per request with Template.substitute
+ITINERARY_PROMPT = Template("""USER INPUTS
+- Source: ${source}
+- Destination(s): ${destination}
+- Dates: ${start_date} to ${end_date} (days: ${duration})
+- People: ${num_people}
+- Average age: ${age_group}
+- ${budget_line}
+- Interests: ${interests}
+- Specific preferences: ${preferences}
+- Accommodation: ${accommodation_type} — ${accommodation_style}
+- Connectivity: Internet=${internet_required}, SIM/eSIM=${sim_card_required}
+- Insurance: ${travel_insurance}, Special assistance: ${special_assistance}
+- Currency display: ${currency}
+
+RESEARCH (recent web snippets; may be partial)
+${context}
+""")
+
 if submitted:
     if not source or not destination.strip():
         st.error("Please enter both source and destination(s).")
@@ -254,19 +618,27 @@ if submitted:
     if date_err:
         st.error(date_err)
         st.stop()
-    destinations = [d.strip() for d in destination.split(',') if d.strip()]
+    # "Paris, paris" would otherwise geocode, search and embed the same city twice
+    destinations = []
+    seen = set()
+    for d in destination.split(','):
+        d = d.strip()
+        if d and d.lower() not in seen:
+            seen.add(d.lower())
+            destinations.append(d)
     if not destinations:
         st.error("Please provide at least one valid destination.")
         st.stop()
+    # Load the embedding model while geocoding is on the network, not after it
+    threading.Thread(target=warm_up_embedder, daemon=True).start()
     # Geocode validation
-    src_geo = geocode_place(source)
+    src_geo, *dest_results = geocode_places([source] + destinations)
     if not src_geo:
         st.error(f"Could not locate source: {source}. Please check spelling.")
         st.stop()
     dest_geos = []
     invalid_dests = []
-    for d in destinations:
-        g = geocode_place(d)
+    for d, g in zip(destinations, dest_results):
         if g:
             dest_geos.append(g)
         else:
@@ -277,7 +649,9 @@ if submitted:
     # Feasibility advisory
     days = (end_date - start_date).days
     try:
-        distance_km = geodesic((src_geo[0], src_geo[1]), (dest_geos[0][0], dest_geos[0][1])).km
+        dest_coords = np.array([(g[0], g[1]) for g in dest_geos], dtype=np.float64)
+        # One vectorized pass over every destination; the farthest one drives the advisory
+        distance_km = float(haversine_km(src_geo[0], src_geo[1], dest_coords[:, 0], dest_coords[:, 1]).max())
     except Exception:
         distance_km = None
     feas_note = None
@@ -291,11 +665,16 @@ if submitted:
 
     # Build research context
     composed_context = ""
+    top_sources, k = retrieval_params(len(destinations), len(interests))
     with st.spinner("🔎 Gathering fresh web context..."):
-        blocks = []
-        for d in destinations:
-            q = f"{d} travel guide attractions tickets opening hours prices neighborhoods best time local food safety"
-            blocks.append(f"## {d}\n" + build_context_with_retrieval(q, k=6))
+        # Each destination is an independent search/fetch/embed pipeline, so run them side by side
+        with script_thread_pool(max_workers=min(len(destinations), 4)) as ex:
+            contexts = list(ex.map(
+                partial(destination_context, top_sources=top_sources, k=k),
+                destinations,
+                [(float(g[0]), float(g[1])) for g in dest_geos],
+            ))
+        blocks = [f"## {d}\n" + ctx for d, ctx in zip(destinations, contexts)]
         composed_context = "\n\n".join(blocks)
     logging.info("Context length: %d for destinations: %s", len(composed_context), ", ".join(destinations))
 
@@ -303,84 +682,83 @@ if submitted:
     currency_directive = currency_choice
     budget_line = f"Approximate budget: {budget} {currency_choice if currency_choice != 'Both' else 'INR & USD'}" if budget and budget > 0 else f"Travel style: {travel_style or 'Moderate'}"
 
-    user_input = {
-        "source": source,
-        "destination": ", ".join(destinations),
-        "start_date": str(start_date),
-        "end_date": str(end_date),
-        "num_people": num_people,
-        "age_group": age_group,
-        "budget": budget,
-        "currency": currency_choice,
-        "travel_style": travel_style,
-        "interests": interests,
-        "preferences": preferences,
-        "accommodation_type": accommodation_type,
-        "accommodation_style": accommodation_style,
-        "internet_required": internet_required,
-        "sim_card_required": sim_card_required,
-        "travel_insurance": travel_insurance,
-        "special_assistance": special_assistance,
-        "duration": (end_date - start_date).days,
-    }
-    prompt = f"""
-You are an expert travel planner with deep knowledge of global destinations. Create a highly detailed, practical, and personalized travel itinerary based on the user's inputs and the current information provided.
-
-USER INPUTS
-- Source: {user_input['source']}
-- Destination(s): {user_input['destination']}
-- Dates: {user_input['start_date']} to {user_input['end_date']} (days: {days})
-- People: {user_input['num_people']}
-- Average age: {user_input['age_group']}
-- {budget_line}
-- Interests: {', '.join(user_input['interests']) if user_input['interests'] else 'General sightseeing'}
-- Specific preferences: {user_input['preferences'] or 'None'}
-- Accommodation: {', '.join(user_input['accommodation_type']) if user_input['accommodation_type'] else 'Any'} — {user_input['accommodation_style']}
-- Connectivity: Internet={user_input['internet_required']}, SIM/eSIM={user_input['sim_card_required']}
-- Insurance: {user_input['travel_insurance']}, Special assistance: {user_input['special_assistance']}
-- Currency display: {currency_directive}
-
-RESEARCH (recent web snippets; may be partial)
-{composed_context}
-
-REQUIREMENTS
-- Plan end-to-end Source → Destination(s) → Source respecting dates and realistic transfers.
-- Include transport per leg with sample timings and fare ranges in {currency_directive}; suggest booking sites/passes.
-- Stays: 2–3 options per destination across budget tiers (budget, mid, premium) with neighborhoods and typical nightly prices.
-- Must-visit places, sightseeing, leisure activities, authentic local food and specialties.
-- Tickets & pre-bookings: explicitly list items needing reservations or timed entry with indicative prices.
-- Packing & prep: travel gear, eSIM/SIM/connectivity, local transport apps, important contacts, nearest airports/railway stations.
-- Costs: itemized rough estimate per day and final total (show in INR and USD or both per selection).
-- If the trip seems too short for distances, add a concise "Planner’s recommendation" suggesting more sensible time.
-- If they have more than enough time, suggest nearby places to visit.
-- Include important links: transport booking sites, emergency contacts, and any pre-booking pages.
-- If local SIMs may not work at destination, suggest reliable eSIM or connectivity options.
-
-FORMAT (Markdown)
-# Trip Overview
-# Transport Plan (with timings and sample fares)
-# Stay Options (by destination and budget tier)
-# Day-by-Day Itinerary (dates; morning/afternoon/evening)
-# Must-Try Food & Specialties
-# Tickets & Pre-bookings
-# Packing & Prep Checklist
-# Estimated Costs (daily + final total in requested currencies)
-# Planner’s Recommendation (only if applicable)
-"""
+    user_input = UserInput(
+        source=source,
+        destination=", ".join(destinations),
+        start_date=str(start_date),
+        end_date=str(end_date),
+        num_people=num_people,
+        age_group=age_group,
+        budget=budget,
+        currency=currency_choice,
+        travel_style=travel_style,
+        interests=tuple(interests),
+        preferences=preferences,
+        accommodation_type=tuple(accommodation_type),
+        accommodation_style=accommodation_style,
+        internet_required=internet_required,
+        sim_card_required=sim_card_required,
+        travel_insurance=travel_insurance,
+        special_assistance=special_assistance,
+        duration=days,
+    )
+    prompt = ITINERARY_PROMPT.substitute(
+        source=user_input.source,
+        destination=user_input.destination,
+        start_date=user_input.start_date,
+        end_date=user_input.end_date,
+        duration=user_input.duration,
+        num_people=user_input.num_people,
+        age_group=user_input.age_group,
+        budget_line=budget_line,
+        interests=", ".join(user_input.interests) if user_input.interests else "General sightseeing",
+        preferences=user_input.preferences or "None",
+        accommodation_type=", ".join(user_input.accommodation_type) if user_input.accommodation_type else "Any",
+        accommodation_style=user_input.accommodation_style,
+        internet_required=user_input.internet_required,
+        sim_card_required=user_input.sim_card_required,
+        travel_insurance=user_input.travel_insurance,
+        special_assistance=user_input.special_assistance,
+        currency=currency_directive,
+        context=composed_context,
+    )
 
-    with st.spinner("🧩 Assembling your itinerary..."):
-        try:
-            text = generate_full_itinerary(model_id, prompt)
-        except Exception as e:
-            st.error(f"Model call failed: {e}")
-            st.stop()
     st.subheader("🗺️ Itinerary")
+    itinerary_view = st.empty()
+    cache_key = itinerary_cache_key(model_id, prompt)
+    text = get_cached_itinerary(cache_key)
+    if text is None:
+        # Only a miss calls the model, so only a miss warms its prefix cache
+        threading.Thread(
+            target=warm_up_prefix,
+            args=(model_id, ITINERARY_SYSTEM_PROMPT),
+            daemon=True,
+        ).start()
+        with st.spinner("🧩 Assembling your itinerary..."):
+            try:
+                # Render tokens as they arrive instead of waiting for the full response
+                text = generate_full_itinerary(
+                    model_id,
+                    prompt,
+                    on_update=itinerary_view.markdown,
+                    system_prompt=ITINERARY_SYSTEM_PROMPT,
+                )
+            except Exception as e:
+                st.error(f"Model call failed: {e}")
+                st.stop()
+        # A truncated or empty stream would otherwise be served for every repeat submission
+        if text and text.strip() and not _missing_sections(_found_sections(text)):
+            cache_itinerary(cache_key, text)
+        else:
+            logging.info("Not caching incomplete itinerary: %s", cache_key)
+    else:
+        logging.info("Itinerary cache hit: %s", cache_key)
     text_str = text if isinstance(text, str) else str(text)
-    st.markdown(text_str)
+    itinerary_view.markdown(text_str)
     # Download options
     st.download_button(
         "⬇️ Download as PDF",
-        data=create_pdf(text_str, user_input),
+        data=create_pdf(text_str, asdict(user_input)),
         file_name="itinerary.pdf",
         mime="application/pdf",
     )
@@ -1,19 +1,20 @@
-from fpdf import FPDF
-from typing import Optional, Dict
+from fpdf import FPDF, XPos, YPos
+from typing import Optional, Dict, Tuple
 from datetime import datetime
 
 
+# Replace common unicode punctuation with ASCII for built-in fonts.
+# One translate() pass in C; maketrans accepts multi-char replacements like '->'
+_ASCII_PUNCT = str.maketrans({
+    '—': '-', '–': '-', '“': '"', '”': '"', '’': "'",
+    '•': '-', '→': '->', '←': '<-', '…': '...',
+})
+
+
 def _normalize_text(text: str) -> str:
     if not text:
         return ""
-    # Replace common unicode punctuation with ASCII for built-in fonts
-    replacements = (
-        ('—', '-'), ('–', '-'), ('“', '"'), ('”', '"'), ('’', "'"),
-        ('•', '-'), ('→', '->'), ('←', '<-'), ('…', '...')
-    )
-    for a, b in replacements:
-        text = text.replace(a, b)
-    return text
+    return text.translate(_ASCII_PUNCT)
 
 def _safe(text: str) -> str:
     # Normalize, then drop any chars not representable in latin-1
@@ -22,55 +23,61 @@ def _safe(text: str) -> str:
 
 class PDF(FPDF):
     def header(self):
-        self.set_font('Arial', 'B', 16)
-        self.cell(0, 10, _safe('AI Trip Planner — Itinerary'), 0, 1, 'C')
+        self.set_font('Helvetica', 'B', 16)
+        self.cell(0, 10, _safe('AI Trip Planner — Itinerary'), new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C')
         self.ln(2)
 
     def footer(self):
         self.set_y(-15)
-        self.set_font('Arial', 'I', 8)
-        self.cell(0, 10, f'Page {self.page_no()}/{{nb}}', 0, 0, 'C')
+        self.set_font('Helvetica', 'I', 8)
+        self.cell(0, 10, f'Page {self.page_no()}/{{nb}}', align='C')
 
 
 def create_pdf(itinerary_markdown: str, user_input: Optional[Dict] = None) -> bytes:
+    summary_lines: Tuple[str, ...] = ()
+    if user_input:
+        summary_lines = (
+            f"From: {user_input.get('source', 'N/A')}",
+            f"To: {user_input.get('destination', 'N/A')}",
+            f"Dates: {user_input.get('start_date', 'N/A')} to {user_input.get('end_date', 'N/A')}",
+            f"People: {user_input.get('num_people', 'N/A')} | Age group: {user_input.get('age_group', 'N/A')}",
+            f"Budget/Style: {user_input.get('budget', 'N/A')} {user_input.get('currency', '')} / {user_input.get('travel_style', '')}",
+        )
+    generated_at = datetime.now().strftime('%Y-%m-%d %H:%M')
+    return _render_pdf(itinerary_markdown or "", summary_lines, generated_at)
+
+
+def _render_pdf(itinerary_markdown: str, summary_lines: Tuple[str, ...], generated_at: str) -> bytes:
     pdf = PDF()
     pdf.alias_nb_pages()
     pdf.add_page()
 
     # Cover
-    pdf.set_font('Arial', 'B', 18)
-    pdf.cell(0, 12, _safe('Your Personalized Travel Itinerary'), 0, 1, 'C')
-    pdf.set_font('Arial', '', 12)
-    pdf.cell(0, 8, datetime.now().strftime('%Y-%m-%d %H:%M'), 0, 1, 'C')
+    pdf.set_font('Helvetica', 'B', 18)
+    pdf.cell(0, 12, _safe('Your Personalized Travel Itinerary'), new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C')
+    pdf.set_font('Helvetica', '', 12)
+    pdf.cell(0, 8, generated_at, new_x=XPos.LMARGIN, new_y=YPos.NEXT, align='C')
     pdf.ln(6)
 
-    if user_input:
-        pdf.set_font('Arial', 'B', 12)
-        pdf.cell(0, 8, _safe('Trip Summary'), 0, 1)
-        pdf.set_font('Arial', '', 11)
-        lines = [
-            f"From: {user_input.get('source', 'N/A')}",
-            f"To: {user_input.get('destination', 'N/A')}",
-            f"Dates: {user_input.get('start_date', 'N/A')} to {user_input.get('end_date', 'N/A')}",
-            f"People: {user_input.get('num_people', 'N/A')} | Age group: {user_input.get('age_group', 'N/A')}",
-            f"Budget/Style: {user_input.get('budget', 'N/A')} {user_input.get('currency', '')} / {user_input.get('travel_style', '')}",
-        ]
-        for l in lines:
-            pdf.cell(0, 7, _safe(l), 0, 1)
+    if summary_lines:
+        pdf.set_font('Helvetica', 'B', 12)
+        pdf.cell(0, 8, _safe('Trip Summary'), new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+        pdf.set_font('Helvetica', '', 11)
+        for l in summary_lines:
+            pdf.cell(0, 7, _safe(l), new_x=XPos.LMARGIN, new_y=YPos.NEXT)
         pdf.ln(4)
 
     # Body — render markdown as plain text safely
-    pdf.set_font('Arial', '', 11)
-    text = (itinerary_markdown or "").strip()
+    pdf.set_font('Helvetica', '', 11)
+    text = itinerary_markdown.strip()
     # Basic cleanup: strip markdown markers
     for md in ('**', '# ', '## ', '### '):
         text = text.replace(md, '')
     # Normalize unicode to ASCII-friendly
     text = _normalize_text(text)
     for para in text.split('\n'):
-        pdf.multi_cell(0, 6, _safe(para))
-
-    # Return as bytes. FPDF returns a Latin-1 encoded string for 'S' dest
-    return pdf.output(dest='S').encode('latin-1', 'ignore')
-
+        # Back to the left margin, or the next full-width cell has no room
+        pdf.multi_cell(0, 6, _safe(para), new_x=XPos.LMARGIN, new_y=YPos.NEXT)
 
+    # fpdf2 builds the document as bytes directly; no str -> Latin-1 round-trip
+    return bytes(pdf.output())
@@ -1,81 +1,288 @@
+import hashlib
 import logging
+import os
 import re
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from functools import lru_cache
+from itertools import accumulate
 from typing import List, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 import numpy as np
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 from duckduckgo_search import DDGS
-from sentence_transformers import SentenceTransformer
-from annoy import AnnoyIndex
+from selectolax.lexbor import LexborHTMLParser
 
 
 logger = logging.getLogger(__name__)
 
 
+# Destinations are researched in parallel; cap simultaneous DDG queries so
+# the fan-out doesn't trip DuckDuckGo's rate limiting
+_DDG_SEMAPHORE = threading.Semaphore(2)
+
+
+SEARCH_CACHE_TTL_S = 1800
+SEARCH_CACHE_SIZE = 128
+# (query, max_results) -> (searched_at, results); failed or empty searches are not kept
+_search_cache: "OrderedDict[Tuple[str, int], Tuple[float, List[dict]]]" = OrderedDict()
+_search_cache_lock = threading.Lock()
+
+
 def ddg_search(query: str, max_results: int = 8) -> List[dict]:
+    key = (query, max_results)
+    with _search_cache_lock:
+        hit = _search_cache.get(key)
+        if hit is not None and time.time() - hit[0] < SEARCH_CACHE_TTL_S:
+            _search_cache.move_to_end(key)
+            return list(hit[1])
     try:
-        with DDGS() as ddgs:
-            return list(ddgs.text(query, max_results=max_results))
+        with _DDG_SEMAPHORE, DDGS() as ddgs:
+            results = list(ddgs.text(query, max_results=max_results))
     except Exception as e:
         logger.warning("DDG search failed: %s", e)
         return []
+    if results:
+        with _search_cache_lock:
+            _search_cache[key] = (time.time(), results)
+            _search_cache.move_to_end(key)
+            while len(_search_cache) > SEARCH_CACHE_SIZE:
+                _search_cache.popitem(last=False)
+    return list(results)
 
 
-def fetch_page_text(url: str, max_chars: int = 4000) -> str:
+_CHARSET_RE = re.compile(r"charset=[\"']?([\w.:-]+)", re.IGNORECASE)
+
+
+def decode_html(raw: bytes, content_type: str = "") -> str:
+    # Lexbor parses UTF-8 only; honour an explicit header charset, otherwise assume UTF-8
+    # (requests' chardet guess over the whole body is the slow part of r.text)
+    m = _CHARSET_RE.search(content_type or "")
     try:
-        headers = {"User-Agent": "Mozilla/5.0"}
-        r = requests.get(url, headers=headers, timeout=10)
+        return raw.decode(m.group(1) if m else "utf-8", errors="replace")
+    except LookupError:
+        return raw.decode("utf-8", errors="replace")
+
+
+def _make_session() -> requests.Session:
+    session = requests.Session()
+    session.headers.update({"User-Agent": "Mozilla/5.0"})
+    # Pool sized for several destinations fetching their candidates at once;
+    # no adapter retries, a failed page is simply skipped
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=0)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# Shared keep-alive pool: repeat hosts skip the TCP and TLS handshake
+_session = _make_session()
+
+
+PAGE_BYTES_LIMIT = 256 * 1024
+MAIN_CONTENT_SELECTOR = "main, article, [role=main], .content, #content"
+PAGE_CACHE_TTL_S = 3600
+PAGE_CACHE_SIZE = 256
+# (url, max_chars) -> (fetched_at, text); only successful, non-empty extracts are kept
+_page_cache: "OrderedDict[Tuple[str, int], Tuple[float, str]]" = OrderedDict()
+_page_cache_lock = threading.Lock()
+# (url, max_chars) -> Future of a download currently in progress
+_page_inflight: "dict[Tuple[str, int], Future]" = {}
+# How long a second caller waits on someone else's download before giving up
+PAGE_INFLIGHT_WAIT_S = 15
+
+
+HOST_MIN_INTERVAL_S = 0.4
+HOST_TABLE_PRUNE_SIZE = 256
+# Next free request slot per host, shared by every fetch in the process
+_host_next_slot: "dict[str, float]" = {}
+_host_lock = threading.Lock()
+
+
+def _pace(url: str) -> None:
+    # Space out requests to the same host; different hosts proceed immediately
+    host = urlsplit(url).netloc.lower()
+    with _host_lock:
+        now = time.monotonic()
+        if len(_host_next_slot) >= HOST_TABLE_PRUNE_SIZE:
+            # A slot already in the past imposes no wait, so forgetting it changes nothing
+            for stale in [h for h, t in _host_next_slot.items() if t <= now]:
+                del _host_next_slot[stale]
+        slot = max(now, _host_next_slot.get(host, 0.0))
+        _host_next_slot[host] = slot + HOST_MIN_INTERVAL_S
+    if slot > now:
+        time.sleep(slot - now)
+
+
+def _download_page_text(url: str, max_chars: int) -> str:
+    # Raises on failure so that errors are never cached
+    _pace(url)
+    with _session.get(url, timeout=10, stream=True) as r:
         r.raise_for_status()
-        soup = BeautifulSoup(r.text, "html.parser")
-        for tag in soup(["script", "style", "nav", "footer", "header", "aside"]):
-            tag.decompose()
-        text = soup.get_text(" ")
-        text = re.sub(r"\s+", " ", text).strip()
-        return text[:max_chars]
+        content_type = r.headers.get("Content-Type", "")
+        # The extract is capped at max_chars anyway: stop downloading multi-MB pages early
+        chunks: List[bytes] = []
+        total = 0
+        for chunk in r.iter_content(chunk_size=32 * 1024):
+            chunks.append(chunk)
+            total += len(chunk)
+            if total >= PAGE_BYTES_LIMIT:
+                break
+    tree = LexborHTMLParser(decode_html(b"".join(chunks), content_type))
+    tree.strip_tags(["script", "style", "nav", "footer", "header", "aside"])
+    # Prefer the article container so sidebars and banners don't eat the extract budget
+    node = tree.css_first(MAIN_CONTENT_SELECTOR) or tree.body
+    text = " ".join(node.text(separator=" ").split()) if node else ""
+    if not text and node is not tree.body and tree.body:
+        text = " ".join(tree.body.text(separator=" ").split())
+    return text[:max_chars]
+
+
+def fetch_page_text(url: str, max_chars: int = 4000) -> str:
+    # Hub pages (Wikivoyage, tourism boards) recur across destinations and resubmissions
+    key = (url, max_chars)
+    with _page_cache_lock:
+        hit = _page_cache.get(key)
+        if hit is not None and time.time() - hit[0] < PAGE_CACHE_TTL_S:
+            _page_cache.move_to_end(key)
+            return hit[1]
+        # Destinations are researched side by side; if another one is already
+        # downloading this URL, wait for its result instead of fetching it again
+        pending = _page_inflight.get(key)
+        if pending is None:
+            pending = _page_inflight[key] = Future()
+            owner = True
+        else:
+            owner = False
+    if not owner:
+        try:
+            return pending.result(timeout=PAGE_INFLIGHT_WAIT_S)
+        except FutureTimeoutError:
+            return ""
+    text = ""
+    try:
+        text = _download_page_text(url, max_chars)
     except Exception as e:
         logger.debug("Failed to fetch %s: %s", url, e)
-        return ""
+    finally:
+        with _page_cache_lock:
+            if text:
+                _page_cache[key] = (time.time(), text)
+                _page_cache.move_to_end(key)
+                while len(_page_cache) > PAGE_CACHE_SIZE:
+                    _page_cache.popitem(last=False)
+            del _page_inflight[key]
+        pending.set_result(text)
+    return text
 
 
 def chunk_text(text: str, chunk_words: int = 220, overlap_words: int = 40) -> List[str]:
     words = text.split()
     chunks: List[str] = []
     step = max(1, chunk_words - overlap_words)
+    # Join once and slice windows by character offset instead of re-joining every window
+    joined = " ".join(words)
+    ends = list(accumulate(len(w) + 1 for w in words))
     for i in range(0, len(words), step):
-        chunk = " ".join(words[i:i + chunk_words])
+        last = min(i + chunk_words, len(words)) - 1
+        chunk = joined[ends[i] - len(words[i]) - 1:ends[last] - 1]
         if chunk:
             chunks.append(chunk)
     return chunks
 
 
+def _normalize_url(url: str) -> str:
+    parts = urlsplit(url)
+    query = urlencode([(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not k.lower().startswith("utm_")])
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip("/"), query, ""))
+
+
 def gather_corpus(query: str, top_sources: int = 3) -> List[Tuple[str, str]]:
     """Return list of (chunk_text, source_url)."""
     results = ddg_search(query, max_results=10)
-    corpus: List[Tuple[str, str]] = []
-    used = 0
+    candidates: List[str] = []
+    seen_urls = set()
     for res in results:
-        if used >= top_sources:
-            break
         url = res.get("href") or res.get("link") or ""
-        if not url:
-            continue
-        body = fetch_page_text(url)
-        if not body:
-            continue
-        for c in chunk_text(body):
-            corpus.append((c, url))
-        used += 1
-        time.sleep(0.35)
+        key = _normalize_url(url) if url else ""
+        # The same page often comes back twice with tracking params or a trailing slash
+        if key and key not in seen_urls:
+            seen_urls.add(key)
+            candidates.append(url)
+    # Over-fetch a few candidates so empty or failed pages don't leave us short
+    candidates = candidates[:top_sources * 2]
+    corpus: List[Tuple[str, str]] = []
+    if not candidates:
+        return corpus
+    ex = ThreadPoolExecutor(max_workers=len(candidates))
+    try:
+        futures = [ex.submit(fetch_page_text, url) for url in candidates]
+        used = 0
+        # Mirrors and syndicated pages repeat text verbatim; embed each chunk once
+        seen = set()
+        # Consume in search rank order so the best-ranked pages win
+        for url, fut in zip(candidates, futures):
+            if used >= top_sources:
+                break
+            body = fut.result()
+            if not body:
+                continue
+            for c in chunk_text(body):
+                if c not in seen:
+                    seen.add(c)
+                    corpus.append((c, url))
+            used += 1
+    finally:
+        # Don't wait on leftover candidates once enough sources are in
+        ex.shutdown(wait=False, cancel_futures=True)
     return corpus
 
 
+EMBED_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+_EMBEDDER_LOCK = threading.Lock()
+
+
+@lru_cache(maxsize=4)
+def _load_embedder(model_name: str):
+    # Imported lazily: pulling in torch at module import delays the first page render
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(model_name)
+
+
+def get_embedder(model_name: str = EMBED_MODEL_NAME):
+    # Loading the model takes seconds; do it once per process, not per store.
+    # The lock keeps concurrent destinations from loading it twice.
+    with _EMBEDDER_LOCK:
+        return _load_embedder(model_name)
+
+
+def warm_up_embedder(model_name: str = EMBED_MODEL_NAME) -> None:
+    # Load the weights and run one forward pass ahead of the first real encode()
+    try:
+        get_embedder(model_name).encode(["warm up"], show_progress_bar=False)
+    except Exception as e:
+        logger.warning("Embedder warm-up failed: %s", e)
+
+
+QUERY_CACHE_SIZE = 512
+# (model_name, query) -> read-only unit vector; shared by every store in the process
+_query_cache: "OrderedDict[Tuple[str, str], np.ndarray]" = OrderedDict()
+_query_cache_lock = threading.Lock()
+
+
 class InMemoryVectorStore:
-    def __init__(self, model_name: str = "sentence-transformers/all-MiniLM-L6-v2"):
-        self.model = SentenceTransformer(model_name)
+    def __init__(self, model_name: str = EMBED_MODEL_NAME):
+        self.model_name = model_name
+        self.model = get_embedder(model_name)
         self.dimension = self.model.get_sentence_embedding_dimension()
-        self.index: AnnoyIndex | None = None
+        # Flat [N, D] matrix of unit vectors: at a few hundred chunks an exact
+        # matmul beats building and walking an ANN index
+        self.embeddings: np.ndarray | None = None
         self.chunks: List[str] = []
         self.sources: List[str] = []
 
@@ -84,36 +291,124 @@ class InMemoryVectorStore:
             return
         self.chunks = [c for c, _ in corpus]
         self.sources = [u for _, u in corpus]
-        embeds = self._embed(self.chunks)
-        self.index = AnnoyIndex(self.dimension, "angular")
-        for i, vec in enumerate(embeds):
-            self.index.add_item(i, vec.astype(np.float32))
-        self.index.build(10)
-        logger.info("Annoy index built with %d chunks", len(self.chunks))
+        self.embeddings = self._embed(self.chunks).astype(np.float32)
+        logger.info("Vector store built with %d chunks", len(self.chunks))
 
     def _embed(self, texts: List[str]) -> np.ndarray:
         em = self.model.encode(texts, batch_size=64, show_progress_bar=False, convert_to_numpy=True, normalize_embeddings=True)
         return em
 
+    def _embed_query(self, query: str) -> np.ndarray:
+        # Destination queries repeat across submissions; only encode ones not seen recently
+        key = (self.model_name, query)
+        with _query_cache_lock:
+            vec = _query_cache.get(key)
+            if vec is not None:
+                _query_cache.move_to_end(key)
+                return vec
+        vec = self._embed([query])[0].astype(np.float32)
+        vec.setflags(write=False)
+        with _query_cache_lock:
+            _query_cache[key] = vec
+            _query_cache.move_to_end(key)
+            while len(_query_cache) > QUERY_CACHE_SIZE:
+                _query_cache.popitem(last=False)
+        return vec
+
     def search(self, query: str, k: int = 6) -> List[Tuple[str, str, float]]:
-        if not self.index or not self.chunks:
+        if self.embeddings is None or not self.chunks:
             return []
-        qv = self._embed([query])[0].astype(np.float32)
-        idxs, distances = self.index.get_nns_by_vector(qv, k, include_distances=True)
-        sims = [1 - (d ** 2) / 2 for d in distances]
-        results: List[Tuple[str, str, float]] = []
-        for i, idx in enumerate(idxs):
-            if 0 <= idx < len(self.chunks):
-                results.append((self.chunks[idx], self.sources[idx], float(sims[i])))
-        return results
-
-
-def build_context_with_retrieval(query: str, k: int = 6) -> str:
-    corpus = gather_corpus(query, top_sources=3)
-    if not corpus:
-        return ""
+        # Embeddings are normalized, so the dot product is the cosine similarity
+        scores = self.embeddings @ self._embed_query(query)
+        k = min(k, len(self.chunks))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.chunks[idx], self.sources[idx], float(scores[idx])) for idx in top]
+
+
+RAG_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "rag_cache")
+# RAG_CACHE_DIR = os.path.join("/tmp", "rag_cache") # uncomment this if you want to deploy the code on Hugging Face
+RAG_CACHE_TTL_S = 24 * 3600
+RAG_CACHE_SWEEP_INTERVAL_S = 3600
+_last_sweep = 0.0
+_sweep_lock = threading.Lock()
+
+
+def _rag_cache_path(query: str, top_sources: int) -> str:
+    # The corpus depends on how many sources were kept, so that is part of the key
+    key = hashlib.blake2b(f"{top_sources}\n{' '.join(query.lower().split())}".encode("utf-8"), digest_size=16).hexdigest()
+    # Versioned so files named by the old scheme are simply never read, and age out in the sweep
+    return os.path.join(RAG_CACHE_DIR, f"v2_{key}.npz")
+
+
+def _load_cached_store(store: InMemoryVectorStore, path: str) -> bool:
+    try:
+        if time.time() - os.path.getmtime(path) > RAG_CACHE_TTL_S:
+            return False
+        with np.load(path, allow_pickle=False) as data:
+            embeddings = data["embeds"]
+            if embeddings.shape[1] != store.dimension:
+                return False
+            store.chunks = data["chunks"].tolist()
+            store.sources = data["sources"].tolist()
+            store.embeddings = embeddings.astype(np.float32)
+        return True
+    except FileNotFoundError:
+        return False
+    except Exception as e:
+        logger.debug("Ignoring unreadable RAG cache %s: %s", path, e)
+        return False
+
+
+def _save_store(store: InMemoryVectorStore, path: str) -> None:
+    try:
+        os.makedirs(RAG_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, chunks=np.array(store.chunks), sources=np.array(store.sources), embeds=store.embeddings)
+        # Atomic swap so a concurrent reader never sees a half-written file
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logger.debug("Failed to write RAG cache %s: %s", path, e)
+    _sweep_rag_cache()
+
+
+def _sweep_rag_cache() -> None:
+    # Expired files are otherwise only skipped on read and pile up forever.
+    # Expiry is the file mtime, so one scandir pass finds them without opening any.
+    global _last_sweep
+    now = time.time()
+    with _sweep_lock:
+        if now - _last_sweep < RAG_CACHE_SWEEP_INTERVAL_S:
+            return
+        _last_sweep = now
+    removed = 0
+    try:
+        with os.scandir(RAG_CACHE_DIR) as entries:
+            for entry in entries:
+                try:
+                    # Leftover .tmp files from a crashed write age out the same way
+                    if now - entry.stat().st_mtime > RAG_CACHE_TTL_S:
+                        os.remove(entry.path)
+                        removed += 1
+                except OSError:
+                    continue
+    except OSError as e:
+        logger.debug("RAG cache sweep failed: %s", e)
+    if removed:
+        logger.info("Removed %d expired RAG cache files", removed)
+
+
+def build_context_with_retrieval(query: str, k: int = 6, top_sources: int = 3) -> str:
     store = InMemoryVectorStore()
-    store.build(corpus)
+    # A recent identical query reuses its chunks and embeddings: no search, fetch or encode
+    path = _rag_cache_path(query, top_sources)
+    if not _load_cached_store(store, path):
+        corpus = gather_corpus(query, top_sources=top_sources)
+        if not corpus:
+            return ""
+        store.build(corpus)
+        _save_store(store, path)
     hits = store.search(query, k=k)
     if not hits:
         return ""
@@ -121,5 +416,3 @@ def build_context_with_retrieval(query: str, k: int = 6) -> str:
     for i, (chunk, url, score) in enumerate(hits, start=1):
         lines.append(f"---\nSource {i}: {url}\nScore: {score:.3f}\nExtract: {chunk}\n")
     return "\n".join(lines)
-
-